@@ -18,3 +18,4 @@ __license__ = 'MIT'
 __copyright__ = 'Copyright 2011 Emanuele Aina'
 
 from .fs import FATFileSystem
+from .compressed import GzipImage, XzImage, open_image
@@ -0,0 +1,159 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+"""
+Reverse map from clusters, sectors or byte offsets to the owning files.
+
+The map is built with a single pass over the directory tree and the FAT
+chains and stored as parallel arrays of contiguous cluster runs sorted
+by their first cluster, so memory grows with the number of fragments
+rather than with the number of clusters.
+"""
+
+import bisect
+from array import array
+from .fat import DirectoryEntry, iter_path_slots, read_raw_directory, slot_first_cluster, slot_name
+
+class ClusterMap(object):
+    def __init__(self, filesystem):
+        self.filesystem = filesystem
+        self.paths = []
+        self.starts = array('I')
+        self.lengths = array('I')
+        self.owners = array('I')
+        self.chain_indexes = array('I')
+        self.build()
+
+    def add_run(self, start, length, owner, chain_index):
+        self.starts.append(start)
+        self.lengths.append(length)
+        self.owners.append(owner)
+        self.chain_indexes.append(chain_index)
+
+    def add_chain(self, owner, cluster, chain=None):
+        """Add the runs of the chain starting at cluster, collecting it in chain."""
+        next_clusters = self.filesystem.fat.next_clusters
+        limit = self.filesystem.cluster_count
+        start = length = index = 0
+        while cluster and index <= limit:
+            if chain is not None:
+                chain.append(cluster)
+            if length and cluster == start + length:
+                length += 1
+            else:
+                if length:
+                    self.add_run(start, length, owner, index - length)
+                start = cluster
+                length = 1
+            index += 1
+            cluster = next_clusters.get(cluster)
+        if length:
+            self.add_run(start, length, owner, index - length)
+
+    def build(self):
+        fs = self.filesystem
+        pending = [('/', fs.root.entry.first_cluster_number)]
+        while pending:
+            path, cluster = pending.pop()
+            clusters = []
+            self.add_chain(len(self.paths), cluster, clusters)
+            self.paths.append(path)
+            prefix = path.rstrip('/') + '/'
+            for offset, raw, lfns in iter_path_slots(read_raw_directory(fs, clusters)):
+                child = prefix + slot_name(raw, lfns)
+                first = slot_first_cluster(raw)
+                if ord(raw[11:12]) & DirectoryEntry.DIRECTORY:
+                    pending.append((child, first))
+                elif first:
+                    self.add_chain(len(self.paths), first)
+                    self.paths.append(child)
+
+        order = sorted(range(len(self.starts)), key=self.starts.__getitem__)
+        for name in ('starts', 'lengths', 'owners', 'chain_indexes'):
+            values = getattr(self, name)
+            setattr(self, name, array('I', [values[i] for i in order]))
+
+    def find_run(self, cluster):
+        i = bisect.bisect_right(self.starts, cluster) - 1
+        if i >= 0 and cluster < self.starts[i] + self.lengths[i]:
+            return i
+        return None
+
+    def lookup(self, cluster):
+        """Return (path, offset in the file) of the owner of cluster, or None."""
+        i = self.find_run(cluster)
+        if i is None:
+            return None
+        index = self.chain_indexes[i] + cluster - self.starts[i]
+        return self.paths[self.owners[i]], index * self.filesystem.boot_sector.bytes_per_cluster
+
+    def offset_to_cluster(self, offset):
+        """Return the cluster holding a byte offset of the image and the offset within it."""
+        b = self.filesystem.boot_sector
+        data_start = self.filesystem.system_area_size * b.bytes_per_sector
+        if offset < data_start:
+            return None, None
+        cluster = (offset - data_start) // b.bytes_per_cluster + 2
+        return cluster, (offset - data_start) % b.bytes_per_cluster
+
+    def lookup_offset(self, offset):
+        """Return (path, offset in the file) of the owner of a byte offset of the image."""
+        cluster, remainder = self.offset_to_cluster(offset)
+        if cluster is None:
+            return None
+        owner = self.lookup(cluster)
+        if owner is None:
+            return None
+        return owner[0], owner[1] + remainder
+
+    def lookup_sector(self, sector):
+        return self.lookup_offset(sector * self.filesystem.boot_sector.bytes_per_sector)
+
+    def lookup_clusters(self, clusters):
+        """Yield (cluster, path, offset in the file) for the owned clusters of a list.
+
+        The clusters are sorted and matched against the runs with a single
+        merge pass instead of a lookup each.
+        """
+        bytes_per_cluster = self.filesystem.boot_sector.bytes_per_cluster
+        i = 0
+        count = len(self.starts)
+        for cluster in sorted(set(clusters)):
+            while i < count and self.starts[i] + self.lengths[i] <= cluster:
+                i += 1
+            if i == count:
+                return
+            if cluster < self.starts[i]:
+                continue
+            index = self.chain_indexes[i] + cluster - self.starts[i]
+            yield cluster, self.paths[self.owners[i]], index * bytes_per_cluster
+
+    def lookup_sectors(self, sectors):
+        """Return a dict mapping the paths owning any of the sectors to those sectors."""
+        b = self.filesystem.boot_sector
+        clusters = {}
+        for sector in sectors:
+            cluster, remainder = self.offset_to_cluster(sector * b.bytes_per_sector)
+            if cluster is not None:
+                clusters.setdefault(cluster, []).append(sector)
+        affected = {}
+        for cluster, path, offset in self.lookup_clusters(clusters):
+            affected.setdefault(path, []).extend(clusters[cluster])
+        for path in affected:
+            affected[path].sort()
+        return affected
+
+    def __repr__(self):
+        return "ClusterMap(\n"  \
+            " owners=%d,\n"     \
+            " runs=%d,\n"       \
+            ")" % (
+            len(self.paths),
+            len(self.starts)
+            )
@@ -0,0 +1,373 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+"""
+Seekable sources for gzip and xz compressed disk images.
+
+Random reads decompress only from the nearest checkpoint instead of from
+the start of the image, and recently used blocks of decompressed data are
+kept in a small cache.
+"""
+
+import io, zlib, bisect
+from collections import OrderedDict
+from struct import pack, unpack
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+class Checkpoint(object):
+    def __init__(self, offset, compressed_offset, decompressor=None):
+        self.offset = offset
+        self.compressed_offset = compressed_offset
+        self.decompressor = decompressor
+
+    @property
+    def is_restart_point(self):
+        return self.decompressor is None
+
+    def __repr__(self):
+        return 'Checkpoint(offset=%d, compressed_offset=%d, restart_point=%s)' % (self.offset, self.compressed_offset, self.is_restart_point)
+
+class CompressedImage(object):
+    block_size = 64 * 1024
+    chunk_size = 64 * 1024
+
+    def __init__(self, source, cache_blocks=64):
+        self.source = source
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+        self.checkpoints = []
+        self.offsets = []
+        self.size = None
+        self.position = 0
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END:
+            self.position = self.get_size() + offset
+        elif whence == io.SEEK_CUR:
+            self.position = self.position + offset
+        else:
+            self.position = offset
+        return self.position
+
+    def read(self, count=None):
+        start = self.position
+        if count is None or count < 0:
+            end = self.get_size()
+        else:
+            end = start + count
+            if self.size is not None:
+                end = min(end, self.size)
+        if end <= start:
+            return b''
+
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        missing = [n for n in range(first, last + 1) if n not in self.cache]
+        if missing:
+            self.load_blocks(missing[0], missing[-1])
+
+        data = []
+        for n in range(first, last + 1):
+            block = self.cache.get(n)
+            if block is None:
+                block = self.load_blocks(n, n)[n]
+            else:
+                self.cache[n] = self.cache.pop(n)
+            skip = max(0, start - n * self.block_size)
+            take = min(len(block), end - n * self.block_size)
+            data.append(block[skip:take])
+            if len(block) < self.block_size:
+                break
+        data = b''.join(data)
+        self.position = start + len(data)
+        return data
+
+    def get_size(self):
+        if self.size is None:
+            for offset, data in self.decompress(2**62, 2**62):
+                pass
+        return self.size
+
+    def load_blocks(self, first, last):
+        """Decompress blocks first..last with a single pass and cache them."""
+        blocks = {}
+        base = None
+        pending = b''
+        for offset, data in self.decompress(first * self.block_size, (last + 1) * self.block_size):
+            if base is None:
+                base = offset
+            if pending:
+                data = pending + data
+            position = 0
+            while len(data) - position >= self.block_size:
+                blocks[base // self.block_size] = data[position:position + self.block_size]
+                position += self.block_size
+                base += self.block_size
+            pending = data[position:]
+        if pending and self.size is not None and base + len(pending) >= self.size:
+            blocks[base // self.block_size] = pending
+        for n in range(first, last + 1):
+            if n not in blocks and self.size is not None and n * self.block_size >= self.size:
+                blocks[n] = b''
+            if n in blocks:
+                self.cache.pop(n, None)
+                self.cache[n] = blocks[n]
+        while len(self.cache) > max(self.cache_blocks, last - first + 1):
+            self.cache.popitem(last=False)
+        return blocks
+
+    def decompress(self, start, end):
+        """Yield (offset, data) pairs of decompressed data covering start..end.
+
+        Offsets are block aligned so that the data can be split into cache
+        blocks by the caller.
+        """
+        raise NotImplementedError()
+
+    def find_checkpoint(self, offset):
+        i = bisect.bisect_right(self.offsets, offset)
+        return self.checkpoints[i - 1]
+
+    def add_checkpoint(self, checkpoint):
+        """Insert a checkpoint in offset order, restart points replace saved states."""
+        i = bisect.bisect_left(self.offsets, checkpoint.offset)
+        if i < len(self.offsets) and self.offsets[i] == checkpoint.offset:
+            if checkpoint.is_restart_point:
+                self.checkpoints[i] = checkpoint
+            return
+        self.checkpoints.insert(i, checkpoint)
+        self.offsets.insert(i, checkpoint.offset)
+
+class GzipImage(CompressedImage):
+    """Seekable gzip compressed image.
+
+    Checkpoints of the inflater state are taken every `spacing` bytes of
+    decompressed data as the image gets read, in the style of zran. The
+    start of each gzip member is a restart point that does not depend on
+    any state: only those can be stored with save_index() and reloaded
+    with the `index` argument, so images compressed as many independent
+    members (eg. with bgzip) can be indexed once and reopened cheaply.
+
+    Each in-memory checkpoint costs about 40KiB, so `spacing` trades
+    memory for the amount of data decompressed by a random read. At most
+    `max_checkpoints` of them are kept: past that the spacing is doubled
+    and every other one is dropped.
+    """
+    def __init__(self, source, spacing=16 * 1024 * 1024, index=None, cache_blocks=64, max_checkpoints=256):
+        super(GzipImage, self).__init__(source, cache_blocks)
+        self.spacing = spacing
+        self.max_checkpoints = max_checkpoints
+        if index is not None:
+            self.load_index(index)
+        else:
+            self.add_checkpoint(Checkpoint(0, 0))
+
+    def save_index(self, fd):
+        points = [c for c in self.checkpoints if c.is_restart_point]
+        fd.write(pack('<4sQI', b'GZIX', self.size or 0, len(points)))
+        for c in points:
+            fd.write(pack('<QQ', c.offset, c.compressed_offset))
+
+    def load_index(self, fd):
+        magic, size, count = unpack('<4sQI', fd.read(16))
+        if magic != b'GZIX':
+            raise IOError('not a gzip image index')
+        self.size = size or None
+        self.checkpoints = []
+        self.offsets = []
+        for i in range(count):
+            offset, compressed_offset = unpack('<QQ', fd.read(16))
+            self.add_checkpoint(Checkpoint(offset, compressed_offset))
+
+    def add_checkpoint(self, checkpoint):
+        super(GzipImage, self).add_checkpoint(checkpoint)
+        if checkpoint.is_restart_point:
+            return
+        saved = [c for c in self.checkpoints if not c.is_restart_point]
+        if len(saved) > self.max_checkpoints:
+            self.spacing *= 2
+            dropped = set(id(c) for c in saved[1::2])
+            self.checkpoints = [c for c in self.checkpoints if id(c) not in dropped]
+            self.offsets = [c.offset for c in self.checkpoints]
+
+    def decompress(self, start, end):
+        aligned = start - start % self.block_size
+        checkpoint = self.find_checkpoint(aligned)
+        offset = checkpoint.offset
+        compressed_offset = checkpoint.compressed_offset
+        if checkpoint.is_restart_point:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decompressor = checkpoint.decompressor.copy()
+        last_checkpoint = offset
+        self.source.seek(compressed_offset)
+
+        while offset < end:
+            chunk = self.source.read(self.chunk_size)
+            if not chunk:
+                data = decompressor.flush()
+                if data and offset + len(data) > aligned:
+                    skip = max(0, aligned - offset)
+                    yield offset + skip, data[skip:]
+                self.size = offset + len(data)
+                return
+            compressed_offset += len(chunk)
+            while chunk:
+                data = decompressor.decompress(chunk, self.chunk_size)
+                chunk = decompressor.unconsumed_tail
+                if data:
+                    if offset + len(data) > aligned:
+                        skip = max(0, aligned - offset)
+                        yield offset + skip, data[skip:]
+                    offset += len(data)
+                if decompressor.unused_data:
+                    # end of a gzip member, the next one starts right after
+                    chunk = decompressor.unused_data
+                    if not b'\x1f\x8b'.startswith(chunk[:2]):
+                        # trailing garbage or padding, ignored like gzip does
+                        self.size = offset
+                        return
+                    self.add_checkpoint(Checkpoint(offset, compressed_offset - len(chunk)))
+                    last_checkpoint = offset
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                elif offset - last_checkpoint >= self.spacing:
+                    self.add_checkpoint(Checkpoint(offset, compressed_offset - len(chunk), decompressor.copy()))
+                    last_checkpoint = offset
+                if offset >= end:
+                    break
+
+class XzImage(CompressedImage):
+    """Seekable xz compressed image.
+
+    The block boundaries listed in the xz index are used as checkpoints,
+    so random access is only as fine grained as the blocks in the image:
+    compress with `xz --block-size=...` or with multiple threads to get
+    more than a single block. It needs the lzma module, which is part of
+    the standard library since Python 3.3.
+    """
+    HEADER_MAGIC = b'\xfd7zXZ\0'
+    FOOTER_MAGIC = b'YZ'
+
+    def __init__(self, source, cache_blocks=64):
+        if lzma is None:
+            raise IOError('xz support requires the lzma module')
+        super(XzImage, self).__init__(source, cache_blocks)
+        self.headers = {}
+        self.read_indexes()
+
+    def read_varint(self, data, position):
+        value = 0
+        shift = 0
+        while True:
+            byte = ord(data[position:position + 1])
+            value |= (byte & 0x7F) << shift
+            position += 1
+            shift += 7
+            if not byte & 0x80:
+                return value, position
+
+    def read_indexes(self):
+        self.source.seek(0, io.SEEK_END)
+        position = self.source.tell()
+        streams = []
+        while position > 0:
+            self.source.seek(position - 12)
+            footer = self.source.read(12)
+            if footer[8:] == b'\0' * 4:
+                position -= 4
+                continue
+            if footer[10:] != self.FOOTER_MAGIC:
+                raise IOError('not a xz image')
+            backward_size = (unpack('<I', footer[4:8])[0] + 1) * 4
+            index_offset = position - 12 - backward_size
+            self.source.seek(index_offset)
+            index = self.source.read(backward_size)
+            count, i = self.read_varint(index, 1)
+            records = []
+            for n in range(count):
+                unpadded, i = self.read_varint(index, i)
+                uncompressed, i = self.read_varint(index, i)
+                records.append((unpadded, uncompressed))
+            blocks_size = sum((u + 3) & ~3 for u, s in records)
+            stream_offset = index_offset - blocks_size - 12
+            streams.insert(0, (stream_offset, records))
+            position = stream_offset
+
+        offset = 0
+        for stream_offset, records in streams:
+            self.source.seek(stream_offset)
+            header = self.source.read(12)
+            if not header.startswith(self.HEADER_MAGIC):
+                raise IOError('not a xz image')
+            compressed_offset = stream_offset + 12
+            for unpadded, uncompressed in records:
+                self.add_checkpoint(Checkpoint(offset, compressed_offset))
+                self.headers[offset] = (header, unpadded)
+                compressed_offset += (unpadded + 3) & ~3
+                offset += uncompressed
+        self.size = offset
+        if not self.checkpoints:
+            self.add_checkpoint(Checkpoint(0, 0))
+
+    def decompress(self, start, end):
+        aligned = start - start % self.block_size
+        for i in range(len(self.checkpoints)):
+            checkpoint = self.checkpoints[i]
+            if checkpoint.offset >= end:
+                return
+            following = self.checkpoints[i + 1].offset if i + 1 < len(self.checkpoints) else self.size
+            if following <= aligned:
+                continue
+            header, unpadded = self.headers[checkpoint.offset]
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+            decompressor.decompress(header)
+            self.source.seek(checkpoint.compressed_offset)
+            remaining = (unpadded + 3) & ~3
+            offset = checkpoint.offset
+            while offset < end:
+                chunk = b''
+                if decompressor.needs_input:
+                    if not remaining:
+                        break
+                    chunk = self.source.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        raise IOError('truncated xz image')
+                    remaining -= len(chunk)
+                # bounded output, a chunk of zeros can inflate to hundreds of MiB
+                data = decompressor.decompress(chunk, self.chunk_size)
+                if data and offset + len(data) > aligned:
+                    skip = max(0, aligned - offset)
+                    yield offset + skip, data[skip:]
+                offset += len(data)
+
+def open_image(path):
+    """Open a raw, gzip or xz compressed image by looking at its magic."""
+    fd = open(path, 'rb')
+    magic = fd.read(6)
+    fd.seek(0)
+    if magic.startswith(b'\x1f\x8b'):
+        return GzipImage(fd)
+    if magic == XzImage.HEADER_MAGIC:
+        return XzImage(fd)
+    return fd
@@ -0,0 +1,200 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+"""
+Compare two snapshots of the same FAT volume.
+
+The FAT regions are compared in bulk to find the clusters whose chain
+changed, and directories are compared by their raw clusters: entries
+are parsed only in directories whose content differs, while unchanged
+ones are just scanned for their subdirectories. Files whose directory
+entry is unchanged are checked against the changed clusters only when
+their directory changed.
+"""
+
+from struct import unpack_from
+from .fat import DirectoryEntry, iter_path_slots, read_raw_directory, slot_first_cluster, slot_name
+
+class Difference(object):
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.modified = []
+        self.moved = []
+
+    def __repr__(self):
+        return "Difference(\n"  \
+            " added=%s,\n"      \
+            " removed=%s,\n"    \
+            " modified=%s,\n"   \
+            " moved=%s,\n"      \
+            ")" % (
+            self.added,
+            self.removed,
+            self.modified,
+            self.moved
+            )
+
+class Slot(object):
+    def __init__(self, path, raw):
+        self.path = path
+        self.raw = raw
+        self.file_attributes = ord(raw[11:12])
+        self.first_cluster_number = slot_first_cluster(raw)
+        self.file_size = unpack_from('<I', raw, 28)[0]
+
+    @property
+    def is_directory(self):
+        return bool(self.file_attributes & DirectoryEntry.DIRECTORY)
+
+    @property
+    def key(self):
+        return (self.first_cluster_number, self.file_size, self.is_directory)
+
+    def same_entry(self, other):
+        # the last access date changes on every read, ignore it
+        return self.raw[:18] == other.raw[:18] and self.raw[20:] == other.raw[20:]
+
+    def same_metadata(self, other):
+        return self.raw[11:18] == other.raw[11:18] and self.raw[20:] == other.raw[20:]
+
+def changed_clusters(old, new, chunk_size=1024 * 1024):
+    """Return the set of clusters whose FAT entry differs between two snapshots."""
+    changed = set()
+    length = old.fat.length
+    for position in range(0, length, chunk_size):
+        size = min(chunk_size, length - position)
+        old.source.seek(old.fat.offset + position)
+        a = old.source.read(size)
+        new.source.seek(new.fat.offset + position)
+        b = new.source.read(size)
+        if a == b:
+            continue
+        for i in range(0, size, 4096):
+            if a[i:i + 4096] == b[i:i + 4096]:
+                continue
+            for j in range(i, min(i + 4096, size), 4):
+                if a[j:j + 4] != b[j:j + 4]:
+                    changed.add((position + j) // 4)
+    return changed
+
+def read_directory(filesystem, cluster):
+    clusters = list(filesystem.fat.get_chain(cluster))
+    return clusters, read_raw_directory(filesystem, clusters)
+
+def read_slots(filesystem, path, data):
+    slots = {}
+    for offset, raw, lfns in iter_path_slots(data):
+        name = slot_name(raw, lfns)
+        slots[name.lower()] = Slot(path + '/' + name, raw)
+    return slots
+
+def list_files(filesystem, slot):
+    """Return the slots of the files in the subtree rooted at slot."""
+    if not slot.is_directory:
+        return [slot]
+    files = []
+    pending = [slot]
+    while pending:
+        directory = pending.pop()
+        clusters, data = read_directory(filesystem, directory.first_cluster_number)
+        for child in read_slots(filesystem, directory.path, data).values():
+            if child.is_directory:
+                pending.append(child)
+            else:
+                files.append(child)
+    return files
+
+def chain_changed(filesystem, cluster, changed):
+    if not changed or not cluster:
+        return False
+    for c in filesystem.fat.get_chain(cluster):
+        if c in changed:
+            return True
+    return False
+
+def record_move(result, old, o, n, changed):
+    result.moved.append((o.path, n.path))
+    if not o.is_directory and (not o.same_metadata(n) or chain_changed(old, o.first_cluster_number, changed)):
+        result.modified.append(n.path)
+
+def diff(old, new):
+    """Return the Difference between two snapshots of the same volume."""
+    if old.boot_sector.bytes_per_cluster != new.boot_sector.bytes_per_cluster \
+       or old.fat.length != new.fat.length:
+        raise IOError('snapshots do not belong to the same volume')
+    changed = changed_clusters(old, new)
+    result = Difference()
+    removed = {}
+    added = {}
+    root = old.root.entry.first_cluster_number
+    pending = [('', '', root, new.root.entry.first_cluster_number)]
+    while True:
+        while pending:
+            old_path, new_path, old_cluster, new_cluster = pending.pop()
+            old_clusters, old_data = read_directory(old, old_cluster)
+            new_clusters, new_data = read_directory(new, new_cluster)
+            if old_clusters == new_clusters and old_data == new_data:
+                for offset, raw, lfns in iter_path_slots(new_data):
+                    slot = Slot(None, raw)
+                    if slot.is_directory:
+                        name = slot_name(raw, lfns)
+                        pending.append((old_path + '/' + name, new_path + '/' + name,
+                                        slot.first_cluster_number, slot.first_cluster_number))
+                continue
+            old_slots = read_slots(old, old_path, old_data)
+            new_slots = read_slots(new, new_path, new_data)
+            for name, o in old_slots.items():
+                n = new_slots.get(name)
+                if n is None or n.is_directory != o.is_directory:
+                    removed.setdefault(o.key, []).append(o)
+                elif o.is_directory:
+                    pending.append((o.path, n.path, o.first_cluster_number, n.first_cluster_number))
+                elif not o.same_entry(n) or chain_changed(old, o.first_cluster_number, changed):
+                    result.modified.append(n.path)
+            for name, n in new_slots.items():
+                o = old_slots.get(name)
+                if o is None or n.is_directory != o.is_directory:
+                    added.setdefault(n.key, []).append(n)
+
+        # entries which disappeared from a place and appeared in another
+        # with the same clusters have been moved, directories keep being
+        # compared in their new place
+        for key in list(added):
+            if not key[0] or key not in removed:
+                continue
+            while added[key] and removed[key]:
+                o = removed[key].pop()
+                n = added[key].pop()
+                record_move(result, old, o, n, changed)
+                if o.is_directory:
+                    pending.append((o.path, n.path, o.first_cluster_number, n.first_cluster_number))
+        if pending:
+            continue
+
+        # remaining directories are added or removed along with their files,
+        # which may have been moved individually
+        removed_files = {}
+        added_files = {}
+        for slots in removed.values():
+            for slot in slots:
+                for f in list_files(old, slot):
+                    removed_files.setdefault(f.key, []).append(f)
+        for slots in added.values():
+            for slot in slots:
+                for f in list_files(new, slot):
+                    added_files.setdefault(f.key, []).append(f)
+        for key in added_files:
+            while key[0] and added_files[key] and removed_files.get(key):
+                record_move(result, old, removed_files[key].pop(), added_files[key].pop(), changed)
+        result.added = sorted(f.path for slots in added_files.values() for f in slots)
+        result.removed = sorted(f.path for slots in removed_files.values() for f in slots)
+        result.modified.sort()
+        result.moved.sort()
+        return result
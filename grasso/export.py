@@ -0,0 +1,179 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+"""
+Stream a directory subtree as a tar or uncompressed zip archive.
+
+Archives are written sequentially to any file object, no seeking or
+temporary files are needed, and file bodies are copied extent by extent
+in bounded chunks.
+
+    python -m grasso.export fs.img /foo > foo.tar
+    python -m grasso.export fs.img /foo --format zip -o foo.zip
+"""
+
+import io, os, sys, zlib, errno, signal, tarfile, argparse
+from struct import pack
+from .fs import FATFileSystem, Directory, File
+from .compressed import open_image
+
+CHUNK_SIZE = 1024 * 1024
+
+class CountingWriter(object):
+    def __init__(self, fd):
+        self.fd = fd
+        self.position = 0
+
+    def write(self, data):
+        self.fd.write(data)
+        self.position += len(data)
+
+def iter_tree(directory):
+    """Yield (archive name, item) for a directory and everything below it."""
+    base = directory.name
+    pending = [(base, directory)]
+    while pending:
+        name, item = pending.pop()
+        yield name, item
+        if isinstance(item, Directory):
+            children = [Directory(item.filesystem, item, e) for e in item.directories if not e.is_dot]
+            children += [File(item.filesystem, item, e) for e in item.files]
+            for child in reversed(children):
+                pending.append(((name + '/' if name else '') + child.name, child))
+
+def iter_chunks(f, chunk_size=CHUNK_SIZE):
+    """Yield the contents of a file, exactly f.size bytes of it.
+
+    Files whose cluster chain is shorter than their size would make the
+    archive headers lie about the data that follows, so they are refused.
+    """
+    remaining = f.size
+    for offset, size in f.extents(0, f.size):
+        while size:
+            f.source.seek(offset, io.SEEK_SET)
+            data = f.source.read(min(size, chunk_size))
+            if not data:
+                raise IOError('image truncated')
+            yield data
+            offset += len(data)
+            size -= len(data)
+            remaining -= len(data)
+    if remaining:
+        raise IOError('file "%s" is %d bytes shorter than its size' % (f.path, remaining))
+
+def write_tar(directory, fd, chunk_size=CHUNK_SIZE):
+    out = CountingWriter(fd)
+    for name, item in iter_tree(directory):
+        if not name:
+            continue
+        entry = item.entry
+        info = tarfile.TarInfo(name)
+        info.mtime = int(entry.modified_timestamp or 0)
+        if isinstance(item, Directory):
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o555 if entry.is_readonly else 0o755
+        else:
+            info.size = item.size
+            info.mode = 0o444 if entry.is_readonly else 0o644
+        out.write(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'strict'))
+        if isinstance(item, Directory):
+            continue
+        for data in iter_chunks(item, chunk_size):
+            out.write(data)
+        if item.size % tarfile.BLOCKSIZE:
+            out.write(b'\0' * (tarfile.BLOCKSIZE - item.size % tarfile.BLOCKSIZE))
+    out.write(b'\0' * (2 * tarfile.BLOCKSIZE))
+    if out.position % tarfile.RECORDSIZE:
+        out.write(b'\0' * (tarfile.RECORDSIZE - out.position % tarfile.RECORDSIZE))
+
+def write_zip(directory, fd, chunk_size=CHUNK_SIZE):
+    """Write an uncompressed zip, with CRCs in data descriptors and ZIP64 offsets."""
+    out = CountingWriter(fd)
+    central = []
+    for name, item in iter_tree(directory):
+        if not name:
+            continue
+        entry = item.entry
+        is_directory = isinstance(item, Directory)
+        if is_directory:
+            name += '/'
+            mode = (0o40555 if entry.is_readonly else 0o40755) << 16 | 0x10
+        else:
+            mode = (0o100444 if entry.is_readonly else 0o100644) << 16
+        name = name.encode('utf-8')
+        offset = out.position
+        flags = 0x0808
+        out.write(pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, 0, entry.modified_time,
+                       entry.modified_date, 0, 0, 0, len(name), 0) + name)
+        crc = 0
+        size = 0
+        if not is_directory:
+            for data in iter_chunks(item, chunk_size):
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                out.write(data)
+        crc &= 0xFFFFFFFF
+        out.write(pack('<IIII', 0x08074b50, crc, size, size))
+        central.append((name, entry, flags, crc, size, offset, mode))
+
+    start = out.position
+    for name, entry, flags, crc, size, offset, mode in central:
+        extra = b''
+        version = 20
+        if offset > 0xFFFFFFFF:
+            extra = pack('<HHQ', 0x0001, 8, offset)
+            offset = 0xFFFFFFFF
+            version = 45
+        out.write(pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | version, version, flags, 0,
+                       entry.modified_time, entry.modified_date, crc, size, size,
+                       len(name), len(extra), 0, 0, 0, mode, offset) + name + extra)
+    end = out.position
+    count = len(central)
+    if count > 0xFFFF or start > 0xFFFFFFFF or end - start > 0xFFFFFFFF:
+        out.write(pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, end - start, start))
+        out.write(pack('<IIQI', 0x07064b50, 0, end, 1))
+        out.write(pack('<IHHHHIIH', 0x06054b50, 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0))
+    else:
+        out.write(pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, end - start, start, 0))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a directory of a FAT image as an archive.')
+    parser.add_argument('image')
+    parser.add_argument('path', nargs='?', default='/')
+    parser.add_argument('--format', choices=('tar', 'zip'), default='tar')
+    parser.add_argument('-o', '--output', help='output file, standard output by default')
+    args = parser.parse_args(argv)
+
+    try:
+        filesystem = FATFileSystem(open_image(args.image))
+        directory = filesystem[args.path]
+    except IOError as e:
+        parser.error(str(e))
+    if not isinstance(directory, Directory):
+        parser.error('"%s" is not a directory' % args.path)
+    if args.output:
+        fd = open(args.output, 'wb')
+    else:
+        fd = getattr(sys.stdout, 'buffer', sys.stdout)
+        if hasattr(signal, 'SIGPIPE'):
+            # die quietly when piped into head and the like
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    writer = write_zip if args.format == 'zip' else write_tar
+    try:
+        writer(directory, fd)
+        fd.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        # keep the interpreter from complaining while flushing at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), fd.fileno())
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -7,10 +7,93 @@
 # Released under the term of a MIT-style license, see LICENSE
 # for details.
 
-import math, io, pprint
-from struct import unpack
+import math, io, pprint, time
+from struct import pack, unpack, unpack_from
 from .util import FragmentInfo, FragmentedIO
 
+def decode_short_name(data):
+    """Return a short name field as text, bytes are already text on Python 2."""
+    if isinstance(data, str):
+        return data
+    return data.decode('cp437')
+
+def dos_timestamp(t=None):
+    """Return the (date, time, time_fine) encoding of a timestamp."""
+    tm = time.localtime(t)
+    date = max(0, tm.tm_year - 1980) << 9 | tm.tm_mon << 5 | tm.tm_mday
+    hms = tm.tm_hour << 11 | tm.tm_min << 5 | tm.tm_sec // 2
+    fine = (tm.tm_sec % 2) * 100
+    return date, hms, fine
+
+def dos_timestamp_to_time(date, hms=0):
+    """Return the timestamp encoded by a (date, time) pair, or None."""
+    if not date:
+        return None
+    try:
+        return time.mktime((1980 + (date >> 9), (date >> 5) & 0x0F, date & 0x1F,
+                            hms >> 11, (hms >> 5) & 0x3F, (hms & 0x1F) * 2, 0, 0, -1))
+    except (ValueError, OverflowError):
+        return None
+
+def short_name_checksum(short_name):
+    s = 0
+    for c in bytearray(short_name):
+        s = (((s & 1) << 7) + (s >> 1) + c) & 0xFF
+    return s
+
+def iter_directory_slots(data):
+    """Yield (offset, raw, long_file_name_raws) for each entry in raw directory data.
+
+    Deleted entries are skipped and no entry object is built, so callers
+    can filter on the raw fields before paying for the parsing.
+    """
+    lfns = []
+    for offset in range(0, len(data) - DirectoryEntry.length + 1, DirectoryEntry.length):
+        raw = data[offset:offset + DirectoryEntry.length]
+        first = ord(raw[0:1])
+        if first == 0:
+            return
+        if first == 0xE5:
+            lfns = []
+            continue
+        if ord(raw[11:12]) == DirectoryEntry.LONGFILENAME:
+            if first & LongFileNameEntry.LAST:
+                lfns = []
+            lfns.append(raw)
+            continue
+        yield offset, raw, lfns
+        lfns = []
+
+def iter_path_slots(data):
+    """Like iter_directory_slots(), skipping the dot entries and the volume label."""
+    for offset, raw, lfns in iter_directory_slots(data):
+        if raw[0:1] == b'.' or ord(raw[11:12]) & DirectoryEntry.LABEL:
+            continue
+        yield offset, raw, lfns
+
+def read_raw_directory(filesystem, clusters):
+    """Return the raw data of the directory stored in a list of clusters."""
+    size = len(clusters) * filesystem.boot_sector.bytes_per_cluster
+    return FragmentedIO(filesystem.source, filesystem.get_chain_items(clusters), size).read()
+
+def slot_first_cluster(raw):
+    return unpack_from('<H', raw, 20)[0] << 16 | unpack_from('<H', raw, 26)[0]
+
+def slot_name(raw, lfns):
+    """Return the name of a raw entry, as PathEntry.name would."""
+    if lfns:
+        r = ''
+        for lfn in reversed(lfns):
+            n = lfn[1:11] + lfn[14:26] + lfn[28:32]
+            if b'\0\0' in n:
+                n = n.rpartition(b'\0\0')[0]
+            r += n.decode('utf-16-le')
+        return r
+    n = raw[0:8]
+    if ord(n[0:1]) == 0x05:
+        n = b'\xe5' + n[1:]
+    return decode_short_name(n.rstrip(b' ') + b'.' + raw[8:11]).lower()
+
 class BootSector(object):
     length = 36
     unpacker = "<3s8sHBHBHHBHHHLL"
@@ -123,6 +206,36 @@ class DirectoryEntry(object):
         self.first_cluster_number_low_fat32 = data[11]
         self.file_size = data[12]
         self.long_file_name_entries = []
+        self.offset = None
+
+    @classmethod
+    def create(cls, filesystem, short_name, file_attributes, first_cluster_number=0, file_size=0, timestamp=None):
+        date, hms, fine = dos_timestamp(timestamp)
+        raw = pack(cls.unpacker, short_name[:8], short_name[8:11], file_attributes, 0,
+                   fine, hms, date, date, first_cluster_number >> 16, hms, date,
+                   first_cluster_number & 0xFFFF, file_size)
+        return cls(filesystem, raw)
+
+    def touch(self, timestamp=None):
+        date, hms, fine = dos_timestamp(timestamp)
+        self.modified_date = self.last_access_date = date
+        self.modified_time = hms
+
+    def pack(self):
+        return pack(self.unpacker,
+            self.dos_file_name_flagged,
+            self.dos_file_extension,
+            self.file_attributes,
+            self.reserved,
+            self.create_time_fine,
+            self.create_time,
+            self.create_date,
+            self.last_access_date,
+            self.first_cluster_number_high_fat32,
+            self.modified_time,
+            self.modified_date,
+            self.first_cluster_number_low_fat32,
+            self.file_size)
 
     @property
     def first_cluster_number_fat32(self):
@@ -135,6 +248,23 @@ class DirectoryEntry(object):
         else:
             return self.first_cluster_number_fat16
 
+    @first_cluster_number.setter
+    def first_cluster_number(self, value):
+        self.first_cluster_number_high_fat32 = self.ea_index_fat16 = value >> 16
+        self.first_cluster_number_low_fat32 = self.first_cluster_number_fat16 = value & 0xFFFF
+
+    @property
+    def modified_timestamp(self):
+        return dos_timestamp_to_time(self.modified_date, self.modified_time)
+
+    @property
+    def create_timestamp(self):
+        return dos_timestamp_to_time(self.create_date, self.create_time)
+
+    @property
+    def short_name(self):
+        return self.dos_file_name_flagged + self.dos_file_extension
+
     @property
     def long_file_name(self):
         if not self.long_file_name_entries:
@@ -146,24 +276,24 @@ class DirectoryEntry(object):
 
     @property
     def is_available(self):
-        return ord(self.dos_file_name_flagged[0]) == 0
+        return ord(self.dos_file_name_flagged[0:1]) == 0
 
     @property
     def is_dot(self):
-        return ord(self.dos_file_name_flagged[0]) == 0x2E
+        return ord(self.dos_file_name_flagged[0:1]) == 0x2E
 
     @property
     def is_deleted(self):
-        return ord(self.dos_file_name_flagged[0]) == 0xE5
+        return ord(self.dos_file_name_flagged[0:1]) == 0xE5
 
     @property
     def dos_file_name(self):
         n = self.dos_file_name_flagged
-        if ord(n[0]) == 0:
+        if ord(n[0:1]) == 0:
             return None
-        if ord(n[0]) == 0x05:
-            n[0] = chr(0xE5)
-        return n.rstrip(' ')
+        if ord(n[0:1]) == 0x05:
+            n = b'\xe5' + n[1:]
+        return decode_short_name(n.rstrip(b' '))
 
     @property
     def is_readonly(self):
@@ -238,7 +368,7 @@ class LabelEntry(DirectoryEntry):
 class PathEntry(DirectoryEntry):
     @property
     def name(self):
-        return self.long_file_name or (self.dos_file_name + '.' + self.dos_file_extension).lower()
+        return self.long_file_name or (self.dos_file_name + '.' + decode_short_name(self.dos_file_extension)).lower()
 
 class SubdirectoryEntry(PathEntry):
     pass
@@ -281,6 +411,36 @@ class LongFileNameEntry(DirectoryEntry):
         self.first_cluster_number_fat16 = data[6]
         self.name2 = data[7]
 
+    @classmethod
+    def create(cls, filesystem, name, short_name):
+        """Return the entries storing a long file name, in on-disk order."""
+        data = name.encode('utf-16-le')
+        if len(data) % 26:
+            data += b'\0\0'
+        while len(data) % 26:
+            data += b'\xff\xff'
+        checksum = short_name_checksum(short_name)
+        count = len(data) // 26
+        entries = []
+        for i in range(count, 0, -1):
+            part = data[(i - 1) * 26:i * 26]
+            sequence_number = i | (cls.LAST if i == count else 0)
+            raw = pack(cls.unpacker, sequence_number, part[:10], DirectoryEntry.LONGFILENAME,
+                       0, checksum, part[10:22], 0, part[22:])
+            entries.append(cls(filesystem, raw))
+        return entries
+
+    def pack(self):
+        return pack(self.unpacker,
+            self.flagged_sequence_number,
+            self.name0,
+            self.file_attributes,
+            self.reserved,
+            self.dos_name_checksum,
+            self.name1,
+            self.first_cluster_number_fat16,
+            self.name2)
+
     @property
     def is_last(self):
         return self.flagged_sequence_number & self.LAST
@@ -292,9 +452,9 @@ class LongFileNameEntry(DirectoryEntry):
     @property
     def name(self):
         n = self.name0 + self.name1 + self.name2
-        if '\0\0' in n:
-            n = n.rpartition('\0\0')[0]
-        return n.decode('utf-16')
+        if b'\0\0' in n:
+            n = n.rpartition(b'\0\0')[0]
+        return n.decode('utf-16-le')
 
     def __repr__(self):
         return self.__class__.__name__ +"(\n"       \
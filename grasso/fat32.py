@@ -7,7 +7,8 @@
 # Released under the term of a MIT-style license, see LICENSE
 # for details.
 
-from struct import unpack
+import bisect
+from struct import pack, unpack
 
 class ExtendedBIOSParameterBlock32(object):
     length = 476
@@ -85,6 +86,11 @@ class FileSystemInformationSector32(object):
         self.reserved_2 = list(data[5])
         self.signature_3 = list(data[6])
 
+    def write(self):
+        source = self.filesystem.source
+        source.seek(self.offset + 488)
+        source.write(pack('<II', self.free_cluster_count, self.most_recent_allocated_cluster_number))
+
     def __repr__(self):
         return "FileSystemInformationSector32(\n"           \
             " offset=%d,\n"                                 \
@@ -108,6 +114,12 @@ class FileSystemInformationSector32(object):
             )
 
 class FAT32(object):
+    END_OF_CHAIN = 0x0FFFFFFF
+    BAD_CLUSTER = 0x0FFFFFF7
+    RESERVED_BITS = 0xF0000000
+    MIRRORING_DISABLED = 0x80
+    ACTIVE_FAT = 0x0F
+
     def __init__(self, filesystem, length):
         self.length = length
         self.filesystem = filesystem
@@ -118,7 +130,8 @@ class FAT32(object):
         self.end_of_cluster = unpack('<I', source.read(4))[0]
         self.next_clusters = {}
         self.bad_clusters = {}
-        entries = self.length/4
+        self.dirty = set()
+        entries = self.length // 4
         for i in range(2, entries):
             v = unpack('<I', source.read(4))[0] & 0x0FFFFFFF
             if not v:
@@ -136,6 +149,61 @@ class FAT32(object):
             yield c
             c = self.next_clusters[c]
 
+    def set_chain(self, clusters, following=None):
+        """Link clusters in a chain, ending it or linking it to following."""
+        for c, n in zip(clusters, clusters[1:]):
+            self.next_clusters[c] = n
+        if clusters:
+            self.next_clusters[clusters[-1]] = following
+        self.dirty.update(clusters)
+
+    def free_chain(self, clusters):
+        for c in clusters:
+            self.next_clusters.pop(c, None)
+        self.dirty.update(clusters)
+
+    def get_value(self, cluster):
+        if cluster in self.bad_clusters:
+            return self.BAD_CLUSTER
+        if cluster not in self.next_clusters:
+            return 0
+        return self.next_clusters[cluster] or self.END_OF_CHAIN
+
+    @property
+    def active_copies(self):
+        """Return the indexes of the copies of the table kept up to date."""
+        flags = self.filesystem.extended_bios_parameter_block.mirroring_flags
+        if flags & self.MIRRORING_DISABLED:
+            return [flags & self.ACTIVE_FAT]
+        return list(range(self.filesystem.boot_sector.fat_count))
+
+    def flush(self):
+        """Write the modified entries to the active copies of the table.
+
+        The reserved upper four bits of each entry are preserved.
+        """
+        source = self.filesystem.source
+        b = self.filesystem.boot_sector
+        first_copy = b.reserved_sector_count * b.bytes_per_sector
+        dirty = sorted(self.dirty)
+        runs = []
+        for c in dirty:
+            if runs and runs[-1][-1] == c - 1:
+                runs[-1].append(c)
+            else:
+                runs.append([c])
+        for run in runs:
+            values = [self.get_value(c) for c in run]
+            unpacker = '<%dI' % len(run)
+            for i in self.active_copies:
+                offset = first_copy + i * self.length + run[0] * 4
+                source.seek(offset)
+                old = unpack(unpacker, source.read(len(run) * 4))
+                data = pack(unpacker, *[o & self.RESERVED_BITS | v for o, v in zip(old, values)])
+                source.seek(offset)
+                source.write(data)
+        self.dirty.clear()
+
     def __repr__(self):
         return "FAT32(\n"               \
             " offset=%d,\n"             \
@@ -150,3 +218,86 @@ class FAT32(object):
             self.media_descriptor,
             self.end_of_cluster,
             )
+
+class ClusterAllocator(object):
+    """Allocate clusters preferring long contiguous runs of free space.
+
+    Free space is tracked as a sorted list of runs, built once from the
+    FAT. New chains go in the first run after the hint that can hold them
+    whole, chains being extended grow in place when possible, and the
+    largest runs are used when no single run is big enough.
+    """
+    def __init__(self, fat, cluster_count, hint=2):
+        self.fat = fat
+        self.last_cluster = cluster_count + 1
+        self.hint = hint if 2 <= hint <= self.last_cluster else 2
+        self.starts = []
+        self.lengths = []
+        used = sorted(c for c in set(fat.next_clusters) | set(fat.bad_clusters) if c <= self.last_cluster)
+        previous = 1
+        for c in used + [self.last_cluster + 1]:
+            if c - previous > 1:
+                self.starts.append(previous + 1)
+                self.lengths.append(c - previous - 1)
+            previous = c
+
+    @property
+    def free_cluster_count(self):
+        return sum(self.lengths)
+
+    def take(self, i, start, count):
+        run_start = self.starts[i]
+        run_end = run_start + self.lengths[i]
+        del self.starts[i], self.lengths[i]
+        if start + count < run_end:
+            self.starts.insert(i, start + count)
+            self.lengths.insert(i, run_end - start - count)
+        if run_start < start:
+            self.starts.insert(i, run_start)
+            self.lengths.insert(i, start - run_start)
+        self.hint = start + count - 1
+        return list(range(start, start + count))
+
+    def allocate(self, count, extend=None):
+        """Return count free clusters, continuing after cluster extend if possible."""
+        if count > self.free_cluster_count:
+            raise IOError('no space left on device')
+        clusters = []
+        if extend is not None:
+            i = bisect.bisect_right(self.starts, extend + 1) - 1
+            if i >= 0 and self.starts[i] + self.lengths[i] > extend + 1:
+                take = min(count, self.starts[i] + self.lengths[i] - extend - 1)
+                clusters += self.take(i, extend + 1, take)
+                count -= take
+        if not count:
+            return clusters
+        i = bisect.bisect_left(self.starts, self.hint)
+        for j in list(range(i, len(self.starts))) + list(range(0, i)):
+            if self.lengths[j] >= count:
+                return clusters + self.take(j, self.starts[j], count)
+        while count:
+            j = self.lengths.index(max(self.lengths))
+            take = min(count, self.lengths[j])
+            clusters += self.take(j, self.starts[j], take)
+            count -= take
+        return clusters
+
+    def free(self, clusters):
+        for c in sorted(set(clusters)):
+            if not 2 <= c <= self.last_cluster:
+                continue
+            i = bisect.bisect_right(self.starts, c)
+            if i > 0 and c < self.starts[i - 1] + self.lengths[i - 1]:
+                # already free
+                continue
+            if i > 0 and self.starts[i - 1] + self.lengths[i - 1] == c:
+                self.lengths[i - 1] += 1
+                if i < len(self.starts) and self.starts[i] == c + 1:
+                    self.lengths[i - 1] += self.lengths[i]
+                    del self.starts[i], self.lengths[i]
+            elif i < len(self.starts) and self.starts[i] == c + 1:
+                self.starts[i] = c
+                self.lengths[i] += 1
+            else:
+                self.starts.insert(i, c)
+                self.lengths.insert(i, 1)
@@ -7,16 +7,39 @@
 # Released under the term of a MIT-style license, see LICENSE
 # for details.
 
-import math
+import math, io, string
 from struct import unpack
-from .util import FragmentInfo, FragmentedIO
+from .util import FragmentInfo, FragmentedIO, ReadAheadPool, is_writable
 from .fat import BootSector, DirectoryEntry, LabelEntry,   \
     DeletedEntry, PathEntry, SubdirectoryEntry, FileEntry, \
-    RootEntry, LongFileNameEntry
+    RootEntry, LongFileNameEntry, iter_path_slots, read_raw_directory, \
+    slot_first_cluster
 from .fat16 import ExtendedBIOSParameterBlock16
-from .fat32 import ExtendedBIOSParameterBlock32, FileSystemInformationSector32, FAT32
+from .query import Query
+from .fat32 import ExtendedBIOSParameterBlock32, FileSystemInformationSector32, FAT32, \
+    ClusterAllocator
+
+def make_entry(filesystem, raw):
+    data = unpack('<B10xB20x', raw)
+    start = data[0]
+    file_attributes = data[1]
+
+    if start == 0:
+        return None
+    elif start == 0xE5:
+        return DeletedEntry(filesystem, raw)
+    elif file_attributes == DirectoryEntry.LONGFILENAME:
+        return LongFileNameEntry(filesystem, raw)
+    elif file_attributes & DirectoryEntry.LABEL:
+        return LabelEntry(filesystem, raw)
+    elif file_attributes & DirectoryEntry.DIRECTORY:
+        return SubdirectoryEntry(filesystem, raw)
+    else:
+        return FileEntry(filesystem, raw)
 
 class Directory(FragmentedIO):
+    SHORT_NAME_CHARS = string.ascii_uppercase + string.digits + "$%'-_@~`!(){}^#&"
+
     def __init__(self, filesystem, parent, entry):
         self.filesystem = filesystem
         self.parent = parent
@@ -24,11 +47,11 @@ class Directory(FragmentedIO):
         self.clusters = list(filesystem.fat.get_chain(entry.first_cluster_number))
         fragments = filesystem.get_chain_items(self.clusters)
         size = len(self.clusters) * filesystem.boot_sector.bytes_per_cluster
-        super(Directory, self).__init__(filesystem.source, fragments, size)
+        super(Directory, self).__init__(filesystem.source, fragments, size, filesystem.readahead)
 
         self.entries = []
         i = 0
-        entry_count = size / DirectoryEntry.length
+        entry_count = size // DirectoryEntry.length
         while i < entry_count:
             entry = self.read_entry()
             if not entry:
@@ -44,8 +67,10 @@ class Directory(FragmentedIO):
                 entry = self.read_entry()
                 entry.long_file_name_entries = lfns
                 i += lfns[0].sequence_number
+            entry.offset = self.tell() - DirectoryEntry.length
             self.entries.append(entry)
         self.seek(0)
+        self.release_readahead()
 
     @property
     def name(self):
@@ -74,23 +99,7 @@ class Directory(FragmentedIO):
                 yield e
 
     def read_entry(self):
-        raw = self.read(DirectoryEntry.length)
-        data = unpack('<B10xB20x', raw)
-        start = data[0]
-        file_attributes = data[1]
-
-        if start == 0:
-            return None
-        elif start == 0xE5:
-            return DeletedEntry(self.filesystem, raw)
-        elif file_attributes == DirectoryEntry.LONGFILENAME:
-            return LongFileNameEntry(self.filesystem, raw)
-        elif file_attributes & DirectoryEntry.LABEL:
-            return LabelEntry(self.filesystem, raw)
-        elif file_attributes & DirectoryEntry.DIRECTORY:
-            return SubdirectoryEntry(self.filesystem, raw)
-        else:
-            return FileEntry(self.filesystem, raw)
+        return make_entry(self.filesystem, self.read(DirectoryEntry.length))
 
     def __iter__(self):
         for d in self.directories:
@@ -116,6 +125,91 @@ class Directory(FragmentedIO):
                 return e
         return None
 
+    def make_short_name(self, name):
+        taken = set(e.short_name for e in self.entries if isinstance(e, PathEntry))
+        base, dot, extension = name.lstrip('.').upper().rpartition('.')
+        if not dot:
+            base, extension = extension, ''
+        clean = lambda s: ''.join(c for c in s if c in self.SHORT_NAME_CHARS)
+        short_base = clean(base) or '_'
+        short_extension = clean(extension)[:3]
+        lossless = short_base == base and short_extension == extension and len(base) <= 8
+        n = 0 if lossless else 1
+        while True:
+            if n:
+                tail = '~%d' % n
+                candidate = short_base[:8 - len(tail)] + tail
+            else:
+                candidate = short_base
+            short_name = (candidate.ljust(8) + short_extension.ljust(3)).encode('ascii')
+            if short_name not in taken:
+                return short_name
+            n += 1
+
+    def find_free_slots(self, count):
+        """Return the offsets of a run of count free slots and of the end marker."""
+        data = self.read_extents(0, self.size)
+        run_start = None
+        run = 0
+        for offset in range(0, len(data), DirectoryEntry.length):
+            first = data[offset:offset + 1]
+            if first == b'\0':
+                return (offset if run_start is None else run_start), offset
+            if first == b'\xe5':
+                if run_start is None:
+                    run_start = offset
+                run += 1
+                if run == count:
+                    return run_start, len(data)
+            else:
+                run_start = None
+                run = 0
+        end = len(data)
+        return (end if run_start is None else run_start), end
+
+    def grow(self, size):
+        """Allocate zeroed clusters until the directory can hold size bytes."""
+        if size <= self.allocated_size:
+            return
+        bytes_per_cluster = self.filesystem.boot_sector.bytes_per_cluster
+        count = (size - self.allocated_size + bytes_per_cluster - 1) // bytes_per_cluster
+        start = self.allocated_size
+        clusters = self.filesystem.allocate(count, self.clusters[-1])
+        self.filesystem.fat.set_chain([self.clusters[-1]] + clusters)
+        self.add_fragments(self.filesystem.get_chain_items(clusters, start))
+        self.clusters += clusters
+        self.seek(start)
+        self.write(b'\0' * (count * bytes_per_cluster))
+
+    def add_entry(self, name, file_attributes, first_cluster_number=0, file_size=0):
+        if not name or '/' in name or '\\' in name or len(name) > 255:
+            raise IOError('invalid file name "' + name + '"')
+        if self.get_entry(name):
+            raise IOError('file "' + name + '" already exists')
+        short_name = self.make_short_name(name)
+        if file_attributes & DirectoryEntry.DIRECTORY:
+            cls = SubdirectoryEntry
+        else:
+            cls = FileEntry
+        entry = cls.create(self.filesystem, short_name, file_attributes, first_cluster_number, file_size)
+        entry.long_file_name_entries = LongFileNameEntry.create(self.filesystem, name, short_name)
+        slots = entry.long_file_name_entries + [entry]
+        offset, end = self.find_free_slots(len(slots))
+        following = offset + len(slots) * DirectoryEntry.length
+        self.grow(following)
+        self.seek(offset)
+        self.write(b''.join(e.pack() for e in slots))
+        if end < following < self.size:
+            # the old end marker got used, make sure the directory still ends
+            self.write(b'\0' * DirectoryEntry.length)
+        entry.offset = following - DirectoryEntry.length
+        self.entries.append(entry)
+        return entry
+
+    def write_entry(self, entry):
+        self.seek(entry.offset)
+        self.write(entry.pack())
+
     def walk(self):
         items = list(self)
         while items:
@@ -142,6 +236,8 @@ class Directory(FragmentedIO):
             )
 
 class File(FragmentedIO):
+    flush_threshold = 32 * 1024 * 1024
+
     def __init__(self, filesystem, parent, entry):
         self.filesystem = filesystem
         self.parent = parent
@@ -149,7 +245,102 @@ class File(FragmentedIO):
         self.clusters = list(filesystem.fat.get_chain(entry.first_cluster_number))
         fragments = filesystem.get_chain_items(self.clusters)
         size = entry.file_size
-        super(File, self).__init__(filesystem.source, fragments, size)
+        super(File, self).__init__(filesystem.source, fragments, size, filesystem.readahead)
+        self.pending = []
+        self.pending_size = 0
+        self.dirty = False
+
+    def read(self, count=None):
+        if self.pending:
+            self.flush()
+        return super(File, self).read(count)
+
+    def write(self, data):
+        """Write data, delaying the allocation of new clusters until flush.
+
+        Returns the number of bytes written.
+        """
+        count = len(data)
+        if self.tell() > self.size:
+            data = b'\0' * (self.tell() - self.size) + data
+            self.seek(self.size)
+        if self.pending and self.tell() != self.size:
+            self.flush()
+        if not self.pending:
+            written = super(File, self).write(data)
+            data = data[written:]
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            self.seek(len(data), io.SEEK_CUR)
+            self.size = max(self.size, self.tell())
+        self.dirty = True
+        if self.pending_size >= self.flush_threshold:
+            self.flush()
+        return count
+
+    def flush(self):
+        fs = self.filesystem
+        if self.pending:
+            data = b''.join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            bytes_per_cluster = fs.boot_sector.bytes_per_cluster
+            count = (len(data) + bytes_per_cluster - 1) // bytes_per_cluster
+            last = self.clusters[-1] if self.clusters else None
+            clusters = fs.allocate(count, last)
+            fs.fat.set_chain(self.clusters[-1:] + clusters)
+            start = self.allocated_size
+            self.add_fragments(fs.get_chain_items(clusters, start))
+            self.clusters += clusters
+            if not self.entry.first_cluster_number:
+                self.entry.first_cluster_number = clusters[0]
+            written = 0
+            for offset, size in self.extents(start, start + len(data)):
+                self.source.seek(offset, io.SEEK_SET)
+                self.source.write(data[written:written + size])
+                written += size
+            if self.readahead is not None:
+                self.readahead.invalidate()
+        if self.dirty:
+            self.entry.file_size = self.size
+            self.entry.touch()
+            self.parent.write_entry(self.entry)
+            fs.flush()
+            self.dirty = False
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self.tell()
+        self.flush()
+        if size > self.size:
+            position = self.tell()
+            self.seek(size)
+            self.write(b'')
+            self.seek(position)
+        bytes_per_cluster = self.filesystem.boot_sector.bytes_per_cluster
+        keep = (size + bytes_per_cluster - 1) // bytes_per_cluster
+        if keep < len(self.clusters):
+            self.filesystem.free(self.clusters[keep:])
+            self.clusters = self.clusters[:keep]
+            self.fragments = self.fragments[:keep]
+            self.starts = self.starts[:keep]
+            if self.clusters:
+                self.filesystem.fat.set_chain(self.clusters[-1:])
+            else:
+                self.entry.first_cluster_number = 0
+        self.size = size
+        self.dirty = True
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     @property
     def name(self):
@@ -177,8 +368,11 @@ class File(FragmentedIO):
             )
 
 class FATFileSystem(object):
-    def __init__(self, fd):
+    def __init__(self, fd, readahead_limit=64*1024*1024):
         self.source = fd
+        self.readahead = ReadAheadPool(readahead_limit)
+        self.file_system_information_sector = None
+        self._allocator = None
         self.boot_sector = BootSector(self)
         if self.type == 'FAT32':
             b = self.boot_sector
@@ -186,7 +380,10 @@ class FATFileSystem(object):
             ebpb = self.extended_bios_parameter_block
             fd.seek(ebpb.file_system_information_sector_number * b.bytes_per_sector)
             self.file_system_information_sector = FileSystemInformationSector32(self)
-            fd.seek(b.reserved_sector_count * b.bytes_per_sector)
+            active = 0
+            if ebpb.mirroring_flags & FAT32.MIRRORING_DISABLED:
+                active = ebpb.mirroring_flags & FAT32.ACTIVE_FAT
+            fd.seek((b.reserved_sector_count + active * ebpb.sector_per_fat) * b.bytes_per_sector)
             self.fat = FAT32(self, ebpb.sector_per_fat * b.bytes_per_sector)
             self.root = Directory(self, None, RootEntry(self))
         else:
@@ -207,18 +404,141 @@ class FATFileSystem(object):
             return b.reserved_sector_count + b.fat_count * b.sectors_per_fat_fat16 \
                    + math.ceil(DirectoryEntry.length * b.max_root_entries_fat16 / b.bytes_per_sector)
 
+    @property
+    def writable(self):
+        return is_writable(self.source)
+
+    @property
+    def cluster_count(self):
+        b = self.boot_sector
+        count = (b.total_sectors - self.system_area_size) // b.sectors_per_cluster
+        return min(count, self.fat.length // 4 - 2)
+
+    @property
+    def allocator(self):
+        if self._allocator is None:
+            hint = self.file_system_information_sector.most_recent_allocated_cluster_number + 1
+            self._allocator = ClusterAllocator(self.fat, self.cluster_count, hint)
+        return self._allocator
+
+    def allocate(self, count, extend=None):
+        if not self.writable:
+            raise IOError('filesystem is read-only')
+        clusters = self.allocator.allocate(count, extend)
+        fsinfo = self.file_system_information_sector
+        fsinfo.most_recent_allocated_cluster_number = clusters[-1]
+        fsinfo.free_cluster_count = self.allocator.free_cluster_count
+        return clusters
+
+    def free(self, clusters):
+        # the allocator must see the FAT before the chain gets released
+        allocator = self.allocator
+        self.fat.free_chain(clusters)
+        allocator.free(clusters)
+        self.file_system_information_sector.free_cluster_count = self.allocator.free_cluster_count
+
+    def flush(self):
+        self.fat.flush()
+        if self._allocator is not None:
+            self.file_system_information_sector.write()
+        if hasattr(self.source, 'flush'):
+            self.source.flush()
+
+    def lookup_parent(self, path):
+        head, sep, name = path.rstrip('/').rpartition('/')
+        parent = self[head or '/']
+        if not isinstance(parent, Directory) or not name:
+            raise IOError('file "'+path+'" not found')
+        return parent, name
+
+    def create(self, path):
+        """Create a file, or truncate it if it exists, and return it for writing."""
+        if not self.writable:
+            raise IOError('filesystem is read-only')
+        parent, name = self.lookup_parent(path)
+        entry = parent.get_entry(name)
+        if entry is None:
+            entry = parent.add_entry(name, DirectoryEntry.ARCHIVE)
+        elif not isinstance(entry, FileEntry):
+            raise IOError('file "'+path+'" is not a regular file')
+        f = File(self, parent, entry)
+        f.truncate(0)
+        return f
+
+    def mkdir(self, path):
+        parent, name = self.lookup_parent(path)
+        if parent.get_entry(name):
+            raise IOError('file "'+path+'" already exists')
+        cluster = self.allocate(1)[0]
+        self.fat.set_chain([cluster])
+        parent_cluster = parent.clusters[0] if parent.parent else 0
+        dot = SubdirectoryEntry.create(self, b'.          ', DirectoryEntry.DIRECTORY, cluster)
+        dotdot = SubdirectoryEntry.create(self, b'..         ', DirectoryEntry.DIRECTORY, parent_cluster)
+        data = dot.pack() + dotdot.pack()
+        fragment = next(self.get_chain_items([cluster]))
+        self.source.seek(fragment.offset)
+        self.source.write(data + b'\0' * (fragment.size - len(data)))
+        entry = parent.add_entry(name, DirectoryEntry.DIRECTORY, cluster)
+        self.flush()
+        return Directory(self, parent, entry)
+
     def cluster_number_to_logical_sector_number(self, cn):
         lsn = self.system_area_size + (cn - 2) * self.boot_sector.sectors_per_cluster
         return lsn
 
-    def get_chain_items(self, clusters):
+    def get_chain_items(self, clusters, chain_offset=0):
         b = self.boot_sector
-        chain_offset = 0
         for c in clusters:
             offset = self.cluster_number_to_logical_sector_number(c) * b.bytes_per_sector
             yield FragmentInfo(c, offset, b.bytes_per_cluster, chain_offset)
             chain_offset += b.bytes_per_cluster
 
+    def find(self, path='/', **predicates):
+        """Yield the items below path matching the predicates of a Query.
+
+        Directories are scanned as raw data and the predicates are checked
+        on the raw entries: only matching items and their ancestors get
+        parsed and have their cluster chains resolved.
+
+            fs.find(name='*.mov', min_size=2**30, modified_after=date(2026, 1, 1))
+        """
+        query = Query(**predicates)
+        start = self[path]
+        if not isinstance(start, Directory):
+            raise IOError('file "'+path+'" is not a directory')
+        # nodes are [parent node, raw, lfns, offset, materialized Directory]
+        def materialize(node):
+            if node[4] is None:
+                parent = materialize(node[0])
+                node[4] = Directory(self, parent, self.make_slot_entry(node[1], node[2], node[3]))
+            return node[4]
+        pending = [([None, None, None, None, start], start.clusters)]
+        while pending:
+            node, clusters = pending.pop()
+            subdirectories = []
+            for offset, raw, lfns in iter_path_slots(read_raw_directory(self, clusters)):
+                is_directory = ord(raw[11:12]) & DirectoryEntry.DIRECTORY
+                child = [node, raw, lfns, offset, None]
+                if query.match(raw, lfns):
+                    entry = self.make_slot_entry(raw, lfns, offset)
+                    if is_directory:
+                        child[4] = Directory(self, materialize(node), entry)
+                    yield child[4] or File(self, materialize(node), entry)
+                if is_directory:
+                    subdirectories.append(child)
+            for child in reversed(subdirectories):
+                if child[4] is not None:
+                    clusters = child[4].clusters
+                else:
+                    clusters = list(self.fat.get_chain(slot_first_cluster(child[1])))
+                pending.append((child, clusters))
+
+    def make_slot_entry(self, raw, lfns, offset):
+        entry = make_entry(self, raw)
+        entry.long_file_name_entries = [LongFileNameEntry(self, r) for r in lfns]
+        entry.offset = offset
+        return entry
+
     def __getitem__(self, path):
         item = self.root
         curr, sep, tail = path.lstrip('/').partition('/')
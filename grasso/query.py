@@ -0,0 +1,91 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+import re, numbers, datetime, fnmatch
+from struct import unpack_from
+from .fat import DirectoryEntry, slot_name
+
+def dos_key(value, round_up=False):
+    """Encode a date, datetime or timestamp as a comparable (date << 16 | time).
+
+    Times are stored with a two seconds resolution, round_up rounds to the
+    following step instead of truncating.
+    """
+    if isinstance(value, numbers.Real):
+        value = datetime.datetime.fromtimestamp(value)
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    if value.year < 1980:
+        return 0
+    date = (value.year - 1980) << 9 | value.month << 5 | value.day
+    hms = value.hour << 11 | value.minute << 5 | value.second // 2
+    if round_up and (value.second % 2 or value.microsecond):
+        hms += 1
+    return date << 16 | hms
+
+class Query(object):
+    """Predicates evaluated on raw directory entries.
+
+    Timestamps are compared in their on-disk encoding, so no entry
+    needs to be decoded to be rejected; the bounds are inclusive for
+    `after` and exclusive for `before`.
+    """
+    # offsets of the (date, time) fields in a raw entry
+    MODIFIED = (24, 22)
+    CREATED = (16, 14)
+    ACCESSED = (18, None)
+
+    def __init__(self, name=None, kind=None, attributes=0, min_size=None, max_size=None,
+                 modified_after=None, modified_before=None,
+                 created_after=None, created_before=None,
+                 accessed_after=None, accessed_before=None):
+        self.predicates = []
+        if kind == 'file':
+            self.predicates.append(lambda raw: not ord(raw[11:12]) & DirectoryEntry.DIRECTORY)
+        elif kind == 'directory':
+            self.predicates.append(lambda raw: ord(raw[11:12]) & DirectoryEntry.DIRECTORY)
+        elif kind is not None:
+            raise ValueError('kind must be "file" or "directory"')
+        if attributes:
+            self.predicates.append(lambda raw: ord(raw[11:12]) & attributes == attributes)
+        if min_size is not None:
+            self.predicates.append(lambda raw: unpack_from('<I', raw, 28)[0] >= min_size)
+        if max_size is not None:
+            self.predicates.append(lambda raw: unpack_from('<I', raw, 28)[0] <= max_size)
+        self.add_range(self.MODIFIED, modified_after, modified_before)
+        self.add_range(self.CREATED, created_after, created_before)
+        self.add_range(self.ACCESSED, accessed_after, accessed_before)
+        self.name = None
+        if name is not None:
+            self.name = re.compile(fnmatch.translate(name), re.IGNORECASE)
+
+    def add_range(self, fields, after, before):
+        date_offset, time_offset = fields
+        def key(raw):
+            date = unpack_from('<H', raw, date_offset)[0]
+            hms = unpack_from('<H', raw, time_offset)[0] if time_offset else 0
+            return date << 16 | hms
+        if after is not None:
+            low = dos_key(after)
+            if time_offset is None:
+                low &= 0xFFFF0000
+            self.predicates.append(lambda raw: key(raw) >= low)
+        if before is not None:
+            high = dos_key(before, True)
+            if time_offset is None and high & 0xFFFF:
+                high = (high | 0xFFFF) + 1
+            self.predicates.append(lambda raw: key(raw) < high)
+
+    def match(self, raw, lfns):
+        for predicate in self.predicates:
+            if not predicate(raw):
+                return False
+        if self.name is not None:
+            return bool(self.name.match(slot_name(raw, lfns)))
+        return True
@@ -0,0 +1,309 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+"""
+HTTP server exposing the contents of a FAT filesystem.
+
+File bodies are sent with os.sendfile() straight from the image, one
+extent at a time, when the image is a regular file and the platform
+supports it. Byte ranges, ETags and directory listings are supported.
+
+    python -m grasso.server fs.img --port 8000
+    python -m grasso.server fs.img --bench /foo/bar --clients 16
+"""
+
+import os, sys, time, socket, threading, argparse
+from collections import OrderedDict
+from email.utils import formatdate
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from http.client import HTTPConnection
+    from urllib.parse import quote, unquote, urlsplit
+    from html import escape
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from httplib import HTTPConnection
+    from urllib import quote, unquote
+    from urlparse import urlsplit
+    from cgi import escape
+from .fat import PathEntry, SubdirectoryEntry, FileEntry
+from .fs import FATFileSystem, Directory, File
+from .compressed import open_image
+
+class FATRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    chunk_size = 1024 * 1024
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are separate writes, don't let Nagle delay the body
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def lookup(self, path):
+        path = path.strip('/')
+        if not path:
+            return self.server.get_directory('')
+        parent, sep, name = path.rpartition('/')
+        directory = self.server.get_directory(parent)
+        if directory is None:
+            return None
+        entry = directory.get_entry(name)
+        if isinstance(entry, SubdirectoryEntry):
+            return self.server.get_directory(path)
+        if isinstance(entry, FileEntry):
+            return File(self.server.filesystem, directory, entry)
+        return None
+
+    def serve(self, send_body):
+        path = unquote(urlsplit(self.path).path)
+        if isinstance(path, bytes):
+            path = path.decode('utf-8', 'replace')
+        item = self.lookup(path)
+        if item is None:
+            self.send_error(404, 'File not found')
+        elif isinstance(item, Directory):
+            if not path.endswith('/'):
+                self.send_response(301)
+                self.send_header('Location', quote(path.encode('utf-8')) + '/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_listing(path, item, send_body)
+        else:
+            self.send_file(item, send_body)
+
+    def send_listing(self, path, directory, send_body):
+        title = escape(path)
+        lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>%s</title></head>' % title,
+                 '<body><h1>%s</h1><ul>' % title]
+        entries = [e for e in directory.entries if isinstance(e, PathEntry) and not e.is_dot]
+        for e in entries:
+            name = e.name + ('/' if isinstance(e, SubdirectoryEntry) else '')
+            lines.append('<li><a href="%s">%s</a></li>' % (quote(name.encode('utf-8')), escape(name)))
+        lines.append('</ul></body></html>')
+        body = '\n'.join(lines).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def etag(self, entry):
+        return '"%x-%x-%x"' % (entry.first_cluster_number, entry.file_size,
+                               entry.modified_date << 16 | entry.modified_time)
+
+    def parse_range(self, size):
+        """Return the (start, end) of the requested range, None or False if unsatisfiable."""
+        header = self.headers.get('Range')
+        if not header or not header.startswith('bytes=') or ',' in header:
+            return None
+        first, sep, last = header[6:].strip().partition('-')
+        try:
+            if not first:
+                start, end = max(0, size - int(last)), size
+            else:
+                start = int(first)
+                end = min(size, int(last) + 1) if last else size
+        except ValueError:
+            return None
+        if start >= end:
+            return False
+        return start, end
+
+    def send_file(self, f, send_body):
+        entry = f.entry
+        etag = self.etag(entry)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        start, end = 0, f.size
+        requested = self.parse_range(f.size)
+        if self.headers.get('If-Range', etag) != etag:
+            requested = None
+        if requested is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % f.size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if requested:
+            start, end = requested
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, f.size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if entry.modified_timestamp is not None:
+            self.send_header('Last-Modified', formatdate(entry.modified_timestamp, usegmt=True))
+        self.end_headers()
+        if send_body:
+            self.wfile.flush()
+            self.send_extents(f, start, end)
+
+    def send_extents(self, f, start, end):
+        fd = self.server.source_fileno
+        for offset, size in f.extents(start, end):
+            if fd is not None:
+                out = self.connection.fileno()
+                while size:
+                    sent = os.sendfile(out, fd, offset, size)
+                    if not sent:
+                        raise IOError('image truncated')
+                    offset += sent
+                    size -= sent
+                continue
+            while size:
+                with self.server.lock:
+                    f.source.seek(offset)
+                    data = f.source.read(min(size, self.chunk_size))
+                if not data:
+                    raise IOError('image truncated')
+                self.wfile.write(data)
+                offset += len(data)
+                size -= len(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class FATHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+    max_directories = 256
+
+    def __init__(self, filesystem, address, quiet=False):
+        HTTPServer.__init__(self, address, FATRequestHandler)
+        self.filesystem = filesystem
+        self.directories = OrderedDict()
+        self.directories_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.quiet = quiet
+        self.stopping = False
+        self.source_fileno = None
+        if hasattr(os, 'sendfile'):
+            try:
+                self.source_fileno = filesystem.source.fileno()
+            except (AttributeError, IOError, ValueError):
+                pass
+
+    def get_directory(self, path):
+        """Return the Directory at a path without slashes at the ends, or None.
+
+        The `max_directories` most recently used directories are kept
+        parsed, only parsing a directory reads the image under the lock.
+        """
+        key = path.lower()
+        with self.directories_lock:
+            directory = self.directories.pop(key, None)
+            if directory is not None:
+                self.directories[key] = directory
+                return directory
+        if not path:
+            directory = self.filesystem.root
+        else:
+            parent, sep, name = path.rpartition('/')
+            parent = self.get_directory(parent)
+            if parent is None:
+                return None
+            entry = parent.get_entry(name)
+            if not isinstance(entry, SubdirectoryEntry):
+                return None
+            with self.lock:
+                directory = Directory(self.filesystem, parent, entry)
+        with self.directories_lock:
+            self.directories[key] = directory
+            while len(self.directories) > self.max_directories:
+                self.directories.popitem(last=False)
+        return directory
+
+    def shutdown(self):
+        self.stopping = True
+        HTTPServer.shutdown(self)
+
+    def handle_error(self, request, client_address):
+        # clients dropped while shutting down are expected
+        if not self.stopping:
+            HTTPServer.handle_error(self, request, client_address)
+
+def make_server(filesystem, host='127.0.0.1', port=8000, quiet=False):
+    return FATHTTPServer(filesystem, (host, port), quiet)
+
+def benchmark(server, path, clients, requests):
+    """Fetch path from server with concurrent loopback clients."""
+    host, port = server.server_address[:2]
+    results = []
+    def client():
+        connection = HTTPConnection(host, port)
+        received = 0
+        for i in range(requests):
+            connection.request('GET', quote(path.encode('utf-8')))
+            response = connection.getresponse()
+            while True:
+                data = response.read(1024 * 1024)
+                if not data:
+                    break
+                received += len(data)
+        connection.close()
+        results.append(received)
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    started = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+    total = sum(results)
+    return clients * requests / elapsed, total / elapsed / 1024 / 1024
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the contents of a FAT image over HTTP.')
+    parser.add_argument('image')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--bench', metavar='PATH', help='benchmark fetching PATH with loopback clients')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=16)
+    args = parser.parse_args(argv)
+
+    filesystem = FATFileSystem(open_image(args.image))
+    if not args.bench:
+        server = make_server(filesystem, args.host, args.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    server = make_server(filesystem, '127.0.0.1', 0, quiet=True)
+    # let the handlers finish closing their connections before exiting
+    server.daemon_threads = False
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    rate, throughput = benchmark(server, args.bench, args.clients, args.requests)
+    server.shutdown()
+    server.server_close()
+    sys.stdout.write('%.1f requests/s, %.1f MiB/s\n' % (rate, throughput))
+
+if __name__ == '__main__':
+    main()
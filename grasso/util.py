@@ -7,9 +7,15 @@
 # Released under the term of a MIT-style license, see LICENSE
 # for details.
 
-import io
+import io, bisect, weakref
 from struct import unpack
 
+def is_writable(fd):
+    if hasattr(fd, 'writable'):
+        return fd.writable()
+    mode = getattr(fd, 'mode', '')
+    return '+' in mode or 'w' in mode or 'a' in mode
+
 class FragmentInfo(object):
     def __init__(self, number, offset, size, chain_offset=0):
         self.number = number
@@ -24,14 +30,55 @@ class FragmentInfo(object):
     def __repr__(self):
         return 'FragmentInfo(number=%d, offset=%d, size=%d, chain_offset_start=%s, chain_offset_end=%d)' % (self.number, self.offset, self.size, self.chain_offset_start, self.chain_offset_end)
 
+class ReadAheadPool(object):
+    """Memory budget shared by the read-ahead buffers of a filesystem."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.buffers = {}
+        self.used = 0
+        self.generation = 0
+
+    def reserve(self, owner, size):
+        self.release(owner)
+        granted = max(0, min(size, self.limit - self.used))
+        if granted:
+            # owners collected without releasing give their memory back too
+            key = id(owner)
+            ref = weakref.ref(owner, lambda ref: self.forget(key))
+            self.buffers[key] = (ref, granted)
+            self.used += granted
+        return granted
+
+    def release(self, owner):
+        self.forget(id(owner))
+
+    def forget(self, key):
+        entry = self.buffers.pop(key, None)
+        if entry is not None:
+            self.used -= entry[1]
+
+    def invalidate(self):
+        self.generation += 1
+
 class FragmentedIO(object):
-    def __init__(self, source, fragments, size):
+    min_readahead = 64 * 1024
+    max_readahead = 8 * 1024 * 1024
+
+    def __init__(self, source, fragments, size, readahead=None):
         self.source = source
         self.fragments = list(fragments)
+        self.starts = [f.chain_offset_start for f in self.fragments]
         self.size = size
 
         self.position = 0
 
+        self.readahead = readahead
+        self.window = 0
+        self.last_end = None
+        self.buffer = b''
+        self.buffer_offset = 0
+        self.buffer_generation = None
+
     def seekable(self):
         return True
 
@@ -39,7 +86,7 @@ class FragmentedIO(object):
         return True
 
     def writable(self):
-        return False
+        return is_writable(self.source)
 
     def tell(self):
         return self.position
@@ -52,21 +99,110 @@ class FragmentedIO(object):
         else:
             self.position = offset
 
+    @property
+    def allocated_size(self):
+        if not self.fragments:
+            return 0
+        return self.fragments[-1].chain_offset_end
+
+    def add_fragments(self, fragments):
+        for fragment in fragments:
+            self.fragments.append(fragment)
+            self.starts.append(fragment.chain_offset_start)
+
+    def write(self, data):
+        """Overwrite data in place, up to the end of the allocated fragments.
+
+        Returns the number of bytes written.
+        """
+        start = self.tell()
+        end = min(start + len(data), self.allocated_size)
+        written = 0
+        for offset, size in self.extents(start, end):
+            self.source.seek(offset, io.SEEK_SET)
+            self.source.write(data[written:written + size])
+            written += size
+        if written and self.readahead is not None:
+            self.readahead.invalidate()
+        self.seek(written, io.SEEK_CUR)
+        self.size = max(self.size, self.tell())
+        return written
+
+    def extents(self, start=0, end=None):
+        """Yield (offset, size) of the physical extents covering start..end.
+
+        Fragments which are adjacent on the source are merged so that
+        they can be transferred with a single operation.
+        """
+        if end is None:
+            end = self.size
+        i = max(0, bisect.bisect_right(self.starts, start) - 1)
+        current = None
+        while i < len(self.fragments) and self.fragments[i].chain_offset_start < end:
+            fragment = self.fragments[i]
+            skip = max(0, start - fragment.chain_offset_start)
+            take = min(fragment.size, end - fragment.chain_offset_start) - skip
+            if take > 0:
+                offset = fragment.offset + skip
+                if current and current[0] + current[1] == offset:
+                    current[1] += take
+                else:
+                    if current:
+                        yield tuple(current)
+                    current = [offset, take]
+            i += 1
+        if current:
+            yield tuple(current)
+
+    def read_extents(self, start, end):
+        data = []
+        for offset, size in self.extents(start, end):
+            self.source.seek(offset, io.SEEK_SET)
+            data.append(self.source.read(size))
+        return b''.join(data)
+
     def read(self, count=None):
-        if count is None:
+        if count is None or count < 0:
             count = self.size
         remaining = self.size - self.tell()
-        count = min(count, remaining)
+        count = max(0, min(count, remaining))
 
         start = self.tell()
         end = start + count
-        data = ''
-        fragments = [f for f in self.fragments if f.in_range(start, end)]
-        for fragment in fragments:
-            skip = max(0, start - fragment.chain_offset_start)
-            take = min(fragment.size, end - fragment.chain_offset_start - skip)
-            position = fragment.offset + skip
-            self.source.seek(position, io.SEEK_SET)
-            data += self.source.read(take)
-            self.seek(take, io.SEEK_CUR)
+        if self.readahead is None:
+            data = self.read_extents(start, end)
+            self.seek(len(data), io.SEEK_CUR)
+            return data
+
+        sequential = start == self.last_end
+        if self.buffer_generation != self.readahead.generation:
+            self.buffer = b''
+        data = b''
+        buffer_end = self.buffer_offset + len(self.buffer)
+        if self.buffer_offset <= start < buffer_end:
+            data = self.buffer[start - self.buffer_offset:end - self.buffer_offset]
+        position = start + len(data)
+        if position < end:
+            if sequential:
+                self.window = min(self.max_readahead, max(self.min_readahead, self.window * 2))
+            else:
+                self.window = 0
+            ahead = min(self.window, self.size - end)
+            if ahead:
+                ahead = self.readahead.reserve(self, ahead)
+            chunk = self.read_extents(position, end + ahead)
+            data += chunk[:end - position]
+            self.buffer = chunk[end - position:]
+            self.buffer_offset = end
+            self.buffer_generation = self.readahead.generation
+        self.last_end = start + len(data)
+        if self.last_end >= self.buffer_offset + len(self.buffer):
+            self.release_readahead()
+        self.seek(len(data), io.SEEK_CUR)
         return data
+
+    def release_readahead(self):
+        """Drop the read-ahead buffer and give its memory back to the pool."""
+        self.buffer = b''
+        if self.readahead is not None:
+            self.readahead.release(self)
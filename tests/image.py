@@ -0,0 +1,151 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+"""
+Build small FAT32 images in memory for the tests.
+
+Trees are dicts mapping names to bytes for files or to dicts for
+subdirectories; every entry gets a long file name and a numbered short
+name. Files whose name contains "frag" are laid out one cluster every
+two, so that their chain is fragmented.
+"""
+
+import io
+from struct import pack
+
+BYTES_PER_SECTOR = 512
+SECTORS_PER_CLUSTER = 1
+RESERVED_SECTORS = 32
+FAT_COUNT = 2
+END_OF_CHAIN = 0x0FFFFFFF
+
+def short_name_checksum(short_name):
+    s = 0
+    for c in bytearray(short_name):
+        s = (((s & 1) << 7) + (s >> 1) + c) & 0xFF
+    return s
+
+def pack_entry(short_name, attributes, cluster, size, date=0x5A21, time=0x6000):
+    return pack('<8s3sBBBHHHHHHHI', short_name[:8], short_name[8:], attributes, 0, 0,
+                time, date, date, cluster >> 16, time, date, cluster & 0xFFFF, size)
+
+class Image(object):
+    def __init__(self, total_sectors=16384):
+        self.total_sectors = total_sectors
+        clusters = (total_sectors - RESERVED_SECTORS) // SECTORS_PER_CLUSTER
+        self.sectors_per_fat = (clusters * 4 + 8 + BYTES_PER_SECTOR - 1) // BYTES_PER_SECTOR
+        self.data_start = RESERVED_SECTORS + FAT_COUNT * self.sectors_per_fat
+        self.cluster_count = (total_sectors - self.data_start) // SECTORS_PER_CLUSTER
+        self.fat = {0: 0x0FFFFFF8, 1: END_OF_CHAIN}
+        self.cursor = 2
+        self.data = bytearray(total_sectors * BYTES_PER_SECTOR)
+        self.names = 0
+
+    @property
+    def bytes_per_cluster(self):
+        return BYTES_PER_SECTOR * SECTORS_PER_CLUSTER
+
+    def cluster_offset(self, cluster):
+        return (self.data_start + (cluster - 2) * SECTORS_PER_CLUSTER) * BYTES_PER_SECTOR
+
+    def allocate(self, count, step=1):
+        clusters = []
+        for i in range(count):
+            while self.cursor in self.fat:
+                self.cursor += 1
+            clusters.append(self.cursor)
+            self.fat[self.cursor] = END_OF_CHAIN
+            self.cursor += step
+        for a, b in zip(clusters, clusters[1:]):
+            self.fat[a] = b
+        return clusters
+
+    def write_chain(self, clusters, data):
+        size = self.bytes_per_cluster
+        for i, cluster in enumerate(clusters):
+            chunk = data[i * size:(i + 1) * size]
+            offset = self.cluster_offset(cluster)
+            self.data[offset:offset + len(chunk)] = chunk
+
+    def entry(self, name, attributes, cluster, size):
+        self.names += 1
+        short_name = ('N%06d' % self.names).ljust(11).encode('ascii')
+        checksum = short_name_checksum(short_name)
+        name = name.encode('utf-16-le') + b'\0\0'
+        while len(name) % 26:
+            name += b'\xff\xff'
+        parts = [name[i:i + 26] for i in range(0, len(name), 26)]
+        slots = []
+        for i in range(len(parts), 0, -1):
+            part = parts[i - 1]
+            sequence = i | (0x40 if i == len(parts) else 0)
+            slots.append(pack('<B10sBBB12sH4s', sequence, part[:10], 0x0F, 0, checksum,
+                              part[10:22], 0, part[22:26]))
+        slots.append(pack_entry(short_name, attributes, cluster, size))
+        return b''.join(slots)
+
+    def add_directory(self, tree, clusters, parent_cluster=None):
+        data = b''
+        if parent_cluster is not None:
+            data += pack_entry(b'.          ', 0x10, clusters[0], 0, 0, 0)
+            data += pack_entry(b'..         ', 0x10, parent_cluster, 0, 0, 0)
+        for name in sorted(tree):
+            value = tree[name]
+            if isinstance(value, dict):
+                sub = self.allocate(4)
+                self.add_directory(value, sub, 0 if parent_cluster is None else clusters[0])
+                data += self.entry(name, 0x10, sub[0], 0)
+            else:
+                count = (len(value) + self.bytes_per_cluster - 1) // self.bytes_per_cluster
+                chain = self.allocate(count, 2 if 'frag' in name else 1)
+                self.write_chain(chain, value)
+                data += self.entry(name, 0x20, chain[0] if chain else 0, len(value))
+        assert len(data) <= len(clusters) * self.bytes_per_cluster, 'directory too big'
+        self.write_chain(clusters, data)
+
+    def finish(self):
+        boot = pack('<3s8sHBHBHHBHHHLL', b'\xebX\x90', b'grasso  ', BYTES_PER_SECTOR,
+                    SECTORS_PER_CLUSTER, RESERVED_SECTORS, FAT_COUNT, 0, 0, 0xF8, 0, 32, 64,
+                    0, self.total_sectors)
+        ebpb = pack('<IHHIHH12sBBB4s11s8s420sH', self.sectors_per_fat, 0, 0, 2, 1, 6, b'\0' * 12,
+                    0x80, 0, 0x29, b'1234', b'NO NAME    ', b'FAT32   ', b'\0' * 420, 0xAA55)
+        self.data[0:BYTES_PER_SECTOR] = boot + ebpb
+        free = self.cluster_count - (len(self.fat) - 2)
+        info = pack('<4s480s4sII12s4s', b'RRaA', b'\0' * 480, b'rrAa', free, self.cursor - 1,
+                    b'\0' * 12, b'\0\0U\xaa')
+        self.data[BYTES_PER_SECTOR:2 * BYTES_PER_SECTOR] = info
+        fat = bytearray(self.sectors_per_fat * BYTES_PER_SECTOR)
+        for cluster, value in self.fat.items():
+            fat[cluster * 4:cluster * 4 + 4] = pack('<I', value)
+        for i in range(FAT_COUNT):
+            offset = (RESERVED_SECTORS + i * self.sectors_per_fat) * BYTES_PER_SECTOR
+            self.data[offset:offset + len(fat)] = fat
+        return io.BytesIO(bytes(self.data))
+
+def build(tree, total_sectors=16384):
+    """Return a BytesIO holding a FAT32 image with the contents of tree."""
+    image = Image(total_sectors)
+    root = image.allocate(4)
+    image.add_directory(tree, root)
+    return image.finish()
+
+def pattern(size, step):
+    return bytes(bytearray((i * step) % 251 for i in range(size)))
+
+def sample():
+    return {
+        'hello.txt': b'hello world\n',
+        'big.bin': pattern(200000, 7),
+        'frag.bin': pattern(50000, 13),
+        'empty.dat': b'',
+        'Documents': {
+            'Readme with spaces.md': b'x' * 1000,
+            'deep': {'leaf.MOV': pattern(3000, 3)},
+        },
+    }
@@ -0,0 +1,56 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+import io, gzip, unittest
+from grasso.compressed import GzipImage, XzImage, lzma
+from grasso import FATFileSystem
+from . import image
+
+@unittest.skipIf(lzma is None, 'lzma is not available')
+class XzImageTest(unittest.TestCase):
+    def test_zeros(self):
+        size = 64 * 1024 * 1024
+        xz = XzImage(io.BytesIO(lzma.compress(b'\0' * size)))
+        self.assertEqual(len(xz.checkpoints), 1)
+        # decompression stays bounded however much a chunk inflates
+        for offset, data in xz.decompress(0, xz.block_size):
+            self.assertTrue(len(data) <= xz.chunk_size)
+        xz.seek(0)
+        self.assertEqual(xz.read(10), b'\0' * 10)
+        xz.seek(size - 5)
+        self.assertEqual(xz.read(10), b'\0' * 5)
+
+    def test_filesystem(self):
+        tree = image.sample()
+        source = image.build(tree)
+        xz = XzImage(io.BytesIO(lzma.compress(source.getvalue())))
+        fs = FATFileSystem(xz)
+        self.assertEqual(fs['/big.bin'].read(), tree['big.bin'])
+        self.assertEqual(fs['/frag.bin'].read(), tree['frag.bin'])
+
+class GzipImageTest(unittest.TestCase):
+    def compress(self, data):
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode='wb') as f:
+            f.write(data)
+        return io.BytesIO(out.getvalue())
+
+    def test_random_reads(self):
+        data = image.pattern(3 * 1024 * 1024, 7)
+        gz = GzipImage(self.compress(data), spacing=64 * 1024, max_checkpoints=8)
+        for offset, count in [(0, 10), (2000000, 70000), (65530, 20), (len(data) - 3, 10), (100, 0)]:
+            gz.seek(offset)
+            self.assertEqual(gz.read(count), data[offset:offset + count])
+        gz.seek(0)
+        self.assertEqual(gz.read(), data)
+        self.assertTrue(len([c for c in gz.checkpoints if not c.is_restart_point]) <= 8)
+        self.assertEqual(gz.offsets, [c.offset for c in gz.checkpoints])
+
+if __name__ == '__main__':
+    unittest.main()
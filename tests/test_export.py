@@ -0,0 +1,46 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+import io, tarfile, zipfile, unittest
+from grasso import FATFileSystem
+from grasso.export import write_tar, write_zip
+from . import image
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = image.sample()
+        self.source = image.build(self.tree)
+        self.fs = FATFileSystem(self.source)
+
+    def test_tar(self):
+        out = io.BytesIO()
+        write_tar(self.fs['/Documents'], out)
+        out.seek(0)
+        archive = tarfile.open(fileobj=out)
+        leaf = archive.extractfile('Documents/deep/leaf.MOV').read()
+        self.assertEqual(leaf, self.tree['Documents']['deep']['leaf.MOV'])
+
+    def test_zip(self):
+        out = io.BytesIO()
+        write_zip(self.fs.root, out)
+        archive = zipfile.ZipFile(io.BytesIO(out.getvalue()))
+        self.assertEqual(archive.read('frag.bin'), self.tree['frag.bin'])
+        self.assertEqual(archive.read('empty.dat'), b'')
+
+    def test_short_chain(self):
+        entry = self.fs.root.get_entry('hello.txt')
+        entry.file_size = 5000
+        self.fs.root.write_entry(entry)
+        self.fs.flush()
+        fs = FATFileSystem(io.BytesIO(self.source.getvalue()))
+        self.assertRaises(IOError, write_tar, fs.root, io.BytesIO())
+        self.assertRaises(IOError, write_zip, fs.root, io.BytesIO())
+
+if __name__ == '__main__':
+    unittest.main()
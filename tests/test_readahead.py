@@ -0,0 +1,71 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+import gc, unittest
+from grasso import FATFileSystem
+from grasso.fs import File
+from grasso.util import ReadAheadPool
+from . import image
+
+class CountingSource(object):
+    def __init__(self, source):
+        self.source = source
+        self.reads = 0
+
+    def seek(self, *args):
+        return self.source.seek(*args)
+
+    def tell(self):
+        return self.source.tell()
+
+    def read(self, count=-1):
+        self.reads += 1
+        return self.source.read(count)
+
+    def writable(self):
+        return False
+
+class ReadAheadTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = dict(('f%02d' % i, image.pattern(300 * 1024, i + 1)) for i in range(12))
+        self.source = CountingSource(image.build(self.tree))
+        self.fs = FATFileSystem(self.source, readahead_limit=400 * 1024)
+
+    def test_finished_files_release_memory(self):
+        files = [f for f in self.fs.root.walk() if isinstance(f, File)]
+        self.assertEqual(self.fs.readahead.used, 0)
+        for f in files:
+            self.source.reads = 0
+            data = []
+            while True:
+                chunk = f.read(4096)
+                if not chunk:
+                    break
+                data.append(chunk)
+            self.assertEqual(b''.join(data), self.tree[f.name])
+            # 75 reads without read-ahead
+            self.assertTrue(self.source.reads < 20, (f.name, self.source.reads))
+            self.assertEqual(self.fs.readahead.used, 0)
+
+    def test_pool_accounting(self):
+        pool = ReadAheadPool(1000)
+        owners = [File.__new__(File) for i in range(3)]
+        self.assertEqual(pool.reserve(owners[0], 600), 600)
+        self.assertEqual(pool.reserve(owners[1], 600), 400)
+        self.assertEqual(pool.reserve(owners[2], 600), 0)
+        self.assertEqual(pool.reserve(owners[0], 100), 100)
+        self.assertEqual(pool.used, 500)
+        pool.release(owners[1])
+        self.assertEqual(pool.used, 100)
+        del owners[0]
+        gc.collect()
+        self.assertEqual(pool.used, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- encoding: utf-8 -*-
+#
+# Grasso - a FAT filesystem parser
+#
+# Copyright 2011 Emanuele Aina <em@nerd.ocracy.org>
+#
+# Released under the term of a MIT-style license, see LICENSE
+# for details.
+
+import io, unittest
+from struct import unpack_from
+from grasso import FATFileSystem
+from . import image
+
+class WriteTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = image.sample()
+        self.source = image.build(self.tree)
+        self.fs = FATFileSystem(self.source)
+
+    def reopen(self):
+        self.fs.flush()
+        return FATFileSystem(io.BytesIO(self.source.getvalue()))
+
+    def fat_values(self, fs, copy=0):
+        data = self.source.getvalue()
+        offset = fs.fat.offset + copy * fs.fat.length
+        return [unpack_from('<I', data, offset + c * 4)[0] & 0x0FFFFFFF
+                for c in range(2, fs.cluster_count + 2)]
+
+    def check_allocation(self, fs):
+        """The free runs, the FSInfo sector and every FAT copy must agree."""
+        allocator = fs.allocator
+        values = self.fat_values(fs)
+        self.assertEqual(values, self.fat_values(fs, 1))
+        free = [i + 2 for i, v in enumerate(values) if v == 0]
+        end = 0
+        for start, length in zip(allocator.starts, allocator.lengths):
+            self.assertTrue(length > 0)
+            self.assertTrue(start > end, 'runs overlap or are not merged')
+            end = start + length
+        runs = [c for start, length in zip(allocator.starts, allocator.lengths)
+                for c in range(start, start + length)]
+        self.assertEqual(runs, free)
+        self.assertEqual(allocator.free_cluster_count, len(free))
+        reopened = self.reopen()
+        self.assertEqual(reopened.file_system_information_sector.free_cluster_count, len(free))
+
+    def test_overwrite_first(self):
+        with self.fs.create('/big.bin') as f:
+            self.assertEqual(f.write(b'replaced'), 8)
+        fs = self.reopen()
+        self.assertEqual(fs['/big.bin'].read(), b'replaced')
+        self.assertEqual(fs['/frag.bin'].read(), self.tree['frag.bin'])
+        self.check_allocation(self.fs)
+
+    def test_overwrite_fragmented(self):
+        data = image.pattern(70000, 5)
+        with self.fs.create('/frag.bin') as f:
+            f.write(data)
+        fs = self.reopen()
+        self.assertEqual(fs['/frag.bin'].read(), data)
+        self.assertEqual(fs['/big.bin'].read(), self.tree['big.bin'])
+        self.check_allocation(self.fs)
+
+    def test_free_twice(self):
+        f = self.fs['/big.bin']
+        clusters = list(f.clusters)
+        f.truncate(0)
+        self.fs.free(clusters[:10])
+        self.check_allocation(self.fs)
+
+    def test_truncate_then_grow(self):
+        f = self.fs['/big.bin']
+        f.truncate(1000)
+        f.seek(0, io.SEEK_END)
+        self.assertEqual(f.write(b'tail' * 1000), 4000)
+        f.close()
+        fs = self.reopen()
+        expected = self.tree['big.bin'][:1000] + b'tail' * 1000
+        self.assertEqual(fs['/big.bin'].read(), expected)
+        self.assertEqual(fs['/big.bin'].size, len(expected))
+        self.check_allocation(self.fs)
+
+    def test_grow_directory(self):
+        self.fs.mkdir(u'/Many')
+        names = [u'entry number %d with a long name.txt' % i for i in range(40)]
+        for i, name in enumerate(names):
+            with self.fs.create(u'/Many/' + name) as f:
+                f.write(('content %d' % i).encode('ascii'))
+        fs = self.reopen()
+        directory = fs['/Many']
+        self.assertTrue(len(directory.clusters) > 1)
+        self.assertEqual(sorted(f.name for f in directory.files), sorted(names))
+        for i, name in enumerate(names):
+            self.assertEqual(fs[u'/Many/' + name].read(), ('content %d' % i).encode('ascii'))
+        self.check_allocation(self.fs)
+
+    def test_long_file_names(self):
+        names = [u'Ünïcödé name.txt', u'a name that needs more than two slots.data', u'x']
+        for name in names:
+            with self.fs.create(u'/Documents/' + name) as f:
+                f.write(name.encode('utf-8'))
+        fs = self.reopen()
+        listed = [f.name for f in fs['/Documents'].files]
+        for name in names:
+            self.assertTrue(name in listed, name)
+            self.assertEqual(fs[u'/Documents/' + name].read(), name.encode('utf-8'))
+        self.assertEqual(fs['/Documents/deep/leaf.MOV'].read(), self.tree['Documents']['deep']['leaf.MOV'])
+
+    def test_reserved_bits_kept(self):
+        data = bytearray(self.source.getvalue())
+        for copy in range(2):
+            offset = self.fs.fat.offset + copy * self.fs.fat.length
+            for c in range(2, self.fs.cluster_count + 2):
+                data[offset + c * 4 + 3] |= 0xA0
+        self.source = io.BytesIO(bytes(data))
+        fs = FATFileSystem(self.source)
+        with fs.create('/hello.txt') as f:
+            f.write(image.pattern(5000, 11))
+        fs.flush()
+        data = self.source.getvalue()
+        for copy in range(2):
+            offset = fs.fat.offset + copy * fs.fat.length
+            for c in range(2, fs.cluster_count + 2):
+                self.assertEqual(unpack_from('<I', data, offset + c * 4)[0] >> 28, 0xA)
+        self.assertEqual(self.reopen()['/hello.txt'].read(), image.pattern(5000, 11))
+
+if __name__ == '__main__':
+    unittest.main()